@@ -1,3 +1,9 @@
+-- Dictionary for artist terms / MusicBrainz tags (songs store ids, not names)
+CREATE TABLE IF NOT EXISTS genre_terms (
+    id SMALLSERIAL PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
 CREATE TABLE IF NOT EXISTS songs (
     track_id TEXT PRIMARY KEY,
     title TEXT NOT NULL,
@@ -5,8 +11,8 @@ CREATE TABLE IF NOT EXISTS songs (
     year INTEGER,
     release TEXT,
     genre TEXT,
-    artist_terms_top TEXT[],
-    artist_mbtags_top TEXT[]
+    artist_terms_top SMALLINT[],   -- genre_terms.id
+    artist_mbtags_top SMALLINT[]   -- genre_terms.id
 );
 
 CREATE TABLE IF NOT EXISTS song_features (
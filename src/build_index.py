@@ -1,15 +1,20 @@
 import os
 import json
+import struct
 from pathlib import Path
 from datetime import datetime
 
+# Single-process script: let BLAS (PCA's randomized SVD) use every core.
+# Must be set before numpy is imported; explicit env settings still win.
+for _var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(_var, str(os.cpu_count() or 1))
+
 import numpy as np
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine
 
-from sklearn.preprocessing import StandardScaler, normalize
+from sklearn.preprocessing import normalize
 from sklearn.decomposition import PCA
-from sklearn.neighbors import NearestNeighbors
 import joblib
 
 load_dotenv()
@@ -25,75 +30,207 @@ ROOT  = Path(__file__).resolve().parents[1]
 MODELS_DIR = ROOT / "models"
 MODELS_DIR.mkdir(parents=True, exist_ok=True)
 
+STANDARDIZE_BLOCK_ROWS = 65_536
+
 USE_PCA = True
 PCA_COMPONENTS = 64
+PCA_MIN_DIM_RATIO = 3
 KNN_METRIC = 'cosine'
 KNN_ALGORITHM = 'brute'
 
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+
+
+"""
+File-like target for COPY ... TO STDOUT (FORMAT BINARY). psycopg2 hands each
+chunk to write(); complete tuples are parsed straight into the preallocated
+track_ids / X arrays and dropped, so only a partial tuple is ever buffered.
+"""
+class VectorCopySink:
+    def __init__(self, n, d):
+        self.track_ids = np.empty(n, dtype=object)
+        self.X = np.empty((n, d), dtype=np.float32)
+        self.count = 0
+        self.finished = False
+        self._buf = bytearray()
+        self._header_read = False
+        # Each float8[] element is a 4-byte length followed by a big-endian double
+        self._element = np.dtype([("len", ">i4"), ("val", ">f8")])
+
+    def write(self, chunk):
+        self._buf += chunk
+        consumed = self._parse(bytes(self._buf))
+        del self._buf[:consumed]
+
+    def _parse(self, data):
+        pos = 0
+        if not self._header_read:
+            if len(data) < 19:
+                return 0
+            if data[:11] != COPY_SIGNATURE:
+                raise RuntimeError("Unexpected COPY BINARY header from Postgres")
+            (ext_len,) = struct.unpack_from(">i", data, 15)
+            if len(data) < 19 + ext_len:
+                return 0
+            pos = 19 + ext_len
+            self._header_read = True
+
+        n, d = self.X.shape
+        while len(data) - pos >= 2:
+            (n_fields,) = struct.unpack_from(">h", data, pos)
+            if n_fields == -1:
+                self.finished = True
+                return len(data)
+
+            # Wait until the whole tuple has arrived
+            if len(data) - pos < 6:
+                break
+            (tid_len,) = struct.unpack_from(">i", data, pos + 2)
+            arr_at = pos + 6 + max(tid_len, 0)
+            if len(data) < arr_at + 4:
+                break
+            (arr_len,) = struct.unpack_from(">i", data, arr_at)
+            end = arr_at + 4 + max(arr_len, 0)
+            if len(data) < end:
+                break
+
+            row, pos = pos, end
+            if tid_len == -1 or arr_len == -1:
+                continue
+
+            # Array header: ndim, has_nulls, element oid, then (size, lower bound) per dim
+            ndim, has_nulls, _ = struct.unpack_from(">iii", data, arr_at + 4)
+            if ndim != 1 or has_nulls:
+                continue
+            tid = data[row + 6:row + 6 + tid_len].decode("utf-8")
+            size = struct.unpack_from(">i", data, arr_at + 16)[0]
+            if size != d:
+                raise ValueError(f"Feature vector for {tid} has {size} dims, expected {d}")
+            if self.count >= n:
+                raise RuntimeError("song_features changed while loading vectors")
+
+            self.track_ids[self.count] = tid
+            self.X[self.count] = np.frombuffer(data, dtype=self._element, count=d, offset=arr_at + 24)["val"]
+            self.count += 1
+        return pos
+
 
 """
 Pull (track_id, features[]) from Postgres.
 Assumes song_features.features is DOUBLE PRECISION[].
+Rows are streamed with a binary COPY and parsed as they arrive into a
+preallocated float32 matrix, so neither the full result set nor any
+per-element Python floats are ever held in memory.
 """
 def load_vectors():
-    with ENGINE.connect() as conn:
-        rows = conn.execute(text("SELECT track_id, features FROM song_features"))
-    
-    track_ids = []
-    X = []
-
-    for tid, features in rows:
-        if tid is None or features is None:
-            continue
-        track_ids.append(str(tid))
-        X.append(np.array(features, dtype=np.float64))
-    
-    X = np.vstack(X)
-    return np.array(track_ids), X
+    raw = ENGINE.raw_connection()
+    try:
+        with raw.cursor() as cur:
+            cur.execute("SELECT count(*), max(array_length(features, 1)) FROM song_features")
+            n, d = cur.fetchone()
+            if not n:
+                raise RuntimeError("song_features is empty; run ingest.py first")
+
+            sink = VectorCopySink(n, d)
+            cur.copy_expert(
+                "COPY (SELECT track_id, features FROM song_features) TO STDOUT WITH (FORMAT BINARY)",
+                sink,
+            )
+    finally:
+        raw.close()
+
+    if not sink.finished:
+        raise RuntimeError("COPY BINARY stream ended without a trailer")
+
+    i = sink.count
+    return sink.track_ids[:i].astype(str), sink.X[:i]
+
+"""
+Standardize X in place (zero mean, unit variance per column), replacing
+StandardScaler. Mean/variance come from one blocked pass that merges per-block
+stats (Welford/Chan) in float64, so only one block is ever upcast; the second
+pass rewrites X in place. Near-constant columns get scale 1, as in sklearn.
+Returns (mean, scale) to persist for query time.
+"""
+def standardize_inplace(X):
+    n, d = X.shape
+    count = 0
+    mean = np.zeros(d)
+    m2 = np.zeros(d)
+
+    for start in range(0, n, STANDARDIZE_BLOCK_ROWS):
+        block = X[start:start + STANDARDIZE_BLOCK_ROWS].astype(np.float64)
+        b_n = len(block)
+        b_mean = block.mean(axis=0)
+        b_m2 = ((block - b_mean) ** 2).sum(axis=0)
+
+        delta = b_mean - mean
+        total = count + b_n
+        mean += delta * (b_n / total)
+        m2 += b_m2 + delta ** 2 * (count * b_n / total)
+        count = total
+
+    var = m2 / n
+    eps = np.finfo(np.float64).eps
+    constant = var <= n * eps * var + (n * mean * eps) ** 2
+    scale = np.where(constant, 1.0, np.sqrt(var))
+
+    X -= mean.astype(X.dtype)
+    X /= scale.astype(X.dtype)
+    return mean, scale
 
 def main():
     track_ids, X = load_vectors()
     n, d = X.shape
     print(f"Loaded {n} vectors of dimension {d}")
 
-    # 1) Standardize features
-    scaler = StandardScaler()
-    X_scaled = scaler.fit_transform(X)
+    # 1) Standardize features in place (single precision from here on)
+    mean, scale = standardize_inplace(X)
+    X_scaled = X
 
     # 2) PCA
     pca = None
     X_emb = X_scaled
 
-    if USE_PCA:
-        n_components = min(PCA_COMPONENTS, X_scaled.shape[1])
-        pca = PCA(n_components=n_components, random_state=42)
-        X_emb = pca.fit_transform(X_scaled)
+    # Only worth it when it actually shrinks the vectors; randomized SVD is
+    # O(n*d*k) instead of a full O(n*d^2) decomposition.
+    if USE_PCA and d > PCA_MIN_DIM_RATIO * PCA_COMPONENTS:
+        pca = PCA(
+            n_components=PCA_COMPONENTS,
+            svd_solver="randomized",
+            n_oversamples=10,
+            random_state=42,
+        )
+        X_emb = pca.fit_transform(X_scaled).astype(np.float32, copy=False)
         print(f"PCA: {d} -> {X_emb.shape[1]} dims")
+    else:
+        print(f"PCA: skipped ({d} dims)")
     
     # 3) L2 Normalization so cosine behaves well
-    X_emb = normalize(X_emb, norm='l2')
-
-    # 4) Fit kNN retriever
-    nn = NearestNeighbors(
-        metric=KNN_METRIC,
-        algorithm=KNN_ALGORITHM,
-    )
-    nn.fit(X_emb)
+    X_emb = normalize(X_emb, norm='l2', copy=False)
 
-    # 5) Save models
-    joblib.dump(scaler, MODELS_DIR / "scaler.pkl")
+    # 4) Save models
+    np.savez(MODELS_DIR / "scaler.npz", mean=mean, scale=scale)
+    (MODELS_DIR / "scaler.pkl").unlink(missing_ok=True)
     if pca is not None:
         joblib.dump(pca, MODELS_DIR / "pca.pkl")
-    joblib.dump(nn, MODELS_DIR / "knn.pkl")
+    else:
+        # don't let the recommender pick up a PCA from an earlier build
+        (MODELS_DIR / "pca.pkl").unlink(missing_ok=True)
+
+    # Plain (non-pickled) arrays so the recommender can memory-map them
+    np.save(MODELS_DIR / "track_ids.npy", track_ids, allow_pickle=False)
+    np.save(MODELS_DIR / "embeddings.npy", np.ascontiguousarray(X_emb), allow_pickle=False)
 
-    np.save(MODELS_DIR / "track_ids.npy", track_ids)
-    np.save(MODELS_DIR / "embeddings.npy", X_emb)
+    # kNN search runs on embeddings.npy; drop index files from earlier builds
+    for stale in ("knn.pkl", "knn.faiss"):
+        (MODELS_DIR / stale).unlink(missing_ok=True)
 
     config = {
         "created_at": datetime.utcnow().isoformat() + "Z",
         "n_songs": int(n),
         "raw_dim": int(d),
-        "use_pca": bool(USE_PCA),
+        "use_pca": pca is not None,
         "pca_components_requested": int(PCA_COMPONENTS),
         "final_dim": int(X_emb.shape[1]),
         "knn_metric": KNN_METRIC,
@@ -1,45 +1,71 @@
+from functools import lru_cache
 from pathlib import Path
-import csv
-import h5py
+import os
 import time
 
+# Read-only batch job over many tiny files: skip HDF5's per-open file locking.
+# Must be set before h5py/HDF5 is loaded (workers inherit it on import).
+os.environ.setdefault("HDF5_USE_FILE_LOCKING", "FALSE")
+
+import h5py
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from joblib import Parallel, delayed
+
 DATA_ROOT = Path("data/msd/MillionSongSubset")
-OUT_TRACKS = Path("data/tracks.csv")
-OUT_FEATURES = Path("data/features.csv")
+OUT_TRACKS = Path("data/tracks.parquet")
+OUT_FEATURES = Path("data/features.parquet")
 
 TOPK_TERMS = 5
 TOPK_MBTAGS = 5
 
-TRACKS_FIELDS = [
-    "track_id",
-    "title",
-    "artist",
-    "year",
-    "release",
-    "genre",             
-    "artist_terms_top",   
-    "artist_mbtags_top",
-    ]
-FEATURE_FIELDS = [
-    "track_id",
-    "duration",
-    "tempo",
-    "loudness",
-    "key",
-    "mode",
-    "time_signature",
-    "danceability",
-    "energy",
-    "key_confidence",
-    "mode_confidence",
-    "time_signature_confidence",
-    "end_of_fade_in",
-    "start_of_fade_out",
-    "song_hotttnesss",
-    "artist_hotttnesss",
-    "artist_familiarity",
-    "year",
-]
+N_JOBS = -1
+BATCH_SIZE = 64
+H5_CHUNK_CACHE_BYTES = 8 << 20
+H5_CHUNK_CACHE_SLOTS = 521
+WRITE_BATCH_ROWS = 10_000
+
+TRACKS_SCHEMA = pa.schema([
+    ("track_id", pa.string()),
+    ("title", pa.string()),
+    ("artist", pa.string()),
+    ("year", pa.int32()),
+    ("release", pa.string()),
+    ("genre", pa.string()),
+    ("artist_terms_top", pa.string()),
+    ("artist_mbtags_top", pa.string()),
+])
+FEATURES_SCHEMA = pa.schema([
+    ("track_id", pa.string()),
+    ("duration", pa.float64()),
+    ("tempo", pa.float64()),
+    ("loudness", pa.float64()),
+    ("key", pa.int32()),
+    ("mode", pa.int32()),
+    ("time_signature", pa.int32()),
+    ("danceability", pa.float64()),
+    ("energy", pa.float64()),
+    ("key_confidence", pa.float64()),
+    ("mode_confidence", pa.float64()),
+    ("time_signature_confidence", pa.float64()),
+    ("end_of_fade_in", pa.float64()),
+    ("start_of_fade_out", pa.float64()),
+    ("song_hotttnesss", pa.float64()),
+    ("artist_hotttnesss", pa.float64()),
+    ("artist_familiarity", pa.float64()),
+    ("year", pa.int32()),
+])
+
+"""
+Decode + strip raw bytes. Memoized: artist terms/tags ("rock", "pop", ...)
+repeat across thousands of files, so each unique value is decoded once per process.
+"""
+@lru_cache(maxsize=4096)
+def decode_bytes(byte_string: bytes) -> str:
+    return byte_string.decode('utf-8', errors='ignore').strip()
+
 
 """
 Convert bytes -> str safely.
@@ -48,7 +74,7 @@ def decode_str(byte_string) -> str:
     if byte_string is None:
         return ""
     if isinstance(byte_string, bytes):
-        return byte_string.decode('utf-8', errors='ignore').strip()
+        return decode_bytes(byte_string)
     return str(byte_string).strip()
 
 
@@ -76,11 +102,31 @@ def to_float(value):
 
 
 """
-Attempt to read songs[0][field]. If anything is missing, return None.
+Fast path for numeric HDF5 scalars (never strings): float, or "" if missing,
+NaN or infinite. No try/except needed on the hot path.
+"""
+def to_float_fast(value):
+    return float(value) if (value is not None and np.isfinite(value)) else ""
+
+
+"""
+Read the single songs[0] record of <group> (a numpy void). If missing, return None.
 """
-def get_field(f: h5py.File, group: str, field: str):
+def get_row(f: h5py.File, group: str):
     try:
-        return f[group]["songs"][0][field]
+        return f[group]["songs"][0]
+    except Exception:
+        return None
+
+
+"""
+Read one field from a record returned by get_row. If anything is missing, return None.
+"""
+def get_field(row, field: str):
+    if row is None:
+        return None
+    try:
+        return row[field]
     except Exception:
         return None
     
@@ -113,37 +159,60 @@ def decode_str_list(arr):
 
 
 """
-Pick the top-k unique string items by descending numeric "weight".
-Used for Echo Nest artist terms:
-- items  = metadata/artist_terms
-- weights = metadata/artist_terms_weight (or fallback to artist_terms_freq)
+Pick the top-k unique string items (case-insensitive) by descending score.
+Blank names and NaN scores are skipped. Only a window of ~2k candidates is
+pulled out with argpartition and sorted; the window widens if duplicates or
+blanks leave fewer than k names.
 """
-def topk_by_weight(items, weights, k: int):
-    if items is None or weights is None:
+def topk_by_score(items, scores, k: int):
+    if items is None or scores is None or k <= 0:
         return []
-    pairs = []
     try:
-        for it, w in zip(items, weights):
-            name = decode_str(it)
-            ww = to_float(w)
-            if name and ww != "":
-                pairs.append((name, ww))
+        n = min(len(items), len(scores))
+        s = np.asarray(scores[:n], dtype=np.float64)
     except Exception:
         return []
 
-    pairs.sort(key=lambda x: x[1], reverse=True)
+    valid = np.flatnonzero(~np.isnan(s))
+    s = s[valid]
+    m = len(s)
+
+    window = min(2 * k, m)
+    while True:
+        if window < m:
+            # everything scoring at least the window-th best, ties included
+            threshold = s[np.argpartition(s, m - window)[m - window]]
+            idx = np.flatnonzero(s >= threshold)
+        else:
+            idx = np.arange(m)
+        # stable sort keeps original order among equal scores
+        idx = idx[np.argsort(-s[idx], kind="stable")]
+
+        result = []
+        seen = set()
+        for i in idx:
+            name = decode_str(items[valid[i]])
+            key = name.lower()
+            if not name or key in seen:
+                continue
+            seen.add(key)
+            result.append(name)
+            if len(result) >= k:
+                return result
+
+        if window >= m:
+            return result
+        window = min(2 * window, m)
 
-    result = []
-    seen = set()
-    for name, _ in pairs:
-        key = name.lower()
-        if key in seen:
-            continue
-        seen.add(key)
-        result.append(name)
-        if len(result) >= k:
-            break
-    return result
+
+"""
+Pick the top-k unique string items by descending numeric "weight".
+Used for Echo Nest artist terms:
+- items  = metadata/artist_terms
+- weights = metadata/artist_terms_weight (or fallback to artist_terms_freq)
+"""
+def topk_by_weight(items, weights, k: int):
+    return topk_by_score(items, weights, k)
 
 
 """
@@ -153,41 +222,30 @@ Used for MusicBrainz tags:
 - counts = musicbrainz/artist_mbtags_count
 """
 def topk_by_count(items, counts, k: int):
-    if items is None or counts is None:
-        return []
-    pairs = []
-    try:
-        for it, c in zip(items, counts):
-            name = decode_str(it)
-            cc = to_float(c)
-            if name and cc != "":
-                pairs.append((name, cc))
-    except Exception:
-        return []
-
-    # Highest counts first
-    pairs.sort(key=lambda x: x[1], reverse=True)
-
-    result = []
-    seen = set()
-    for name, _ in pairs:
-        key = name.lower()
-        if key in seen:
-            continue
-        seen.add(key)
-        result.append(name)
-        if len(result) >= k:
-            break
-    return result
+    return topk_by_score(items, counts, k)
 
 
 """
-Join a list of strings into a single pipe-delimited string for CSV storage.
+Join a list of strings into a single pipe-delimited string for storage.
 """
 def join_pipe(items):
     return "|".join(items) if items else ""
 
 
+"""
+Build a typed RecordBatch from buffered row dicts.
+Blank ("") values in non-string columns become nulls.
+"""
+def to_record_batch(rows, schema: pa.Schema):
+    columns = {}
+    for field in schema:
+        values = [row[field.name] for row in rows]
+        if not pa.types.is_string(field.type):
+            values = [None if v == "" else v for v in values]
+        columns[field.name] = values
+    return pa.RecordBatch.from_pydict(columns, schema=schema)
+
+
 """
 Read one .h5 file and return:
  - tracks_row dict
@@ -195,20 +253,31 @@ Read one .h5 file and return:
 If track_id is missing, return (None, None) to signal skip.
 """
 def extract_one(h5_path: Path):
-    with h5py.File(h5_path, "r") as f:
+    with h5py.File(
+        h5_path,
+        "r",
+        libver="latest",
+        rdcc_nbytes=H5_CHUNK_CACHE_BYTES,
+        rdcc_nslots=H5_CHUNK_CACHE_SLOTS,
+    ) as f:
+        # Each group's "songs" table has one row; read each row once
+        a = get_row(f, "analysis")
+        m = get_row(f, "metadata")
+        mb = get_row(f, "musicbrainz")
+
         # Stable ID
-        track_id = decode_str(get_field(f, "analysis", "track_id") or "")
+        track_id = decode_str(get_field(a, "track_id") or "")
         if not track_id:
             return None, None
 
         # Display metadata
-        title = decode_str(get_field(f, "metadata", "title") or "")
-        artist = decode_str(get_field(f, "metadata", "artist_name") or "")
-        release = decode_str(get_field(f, "metadata", "release") or "")
+        title = decode_str(get_field(m, "title") or "")
+        artist = decode_str(get_field(m, "artist_name") or "")
+        release = decode_str(get_field(m, "release") or "")
 
-        year_raw = get_field(f, "musicbrainz", "year")
+        year_raw = get_field(mb, "year")
         if year_raw is None:
-            year_raw = get_field(f, "metadata", "year")
+            year_raw = get_field(m, "year")
 
         year = to_int(year_raw)
 
@@ -229,27 +298,27 @@ def extract_one(h5_path: Path):
         genre = terms_top[0] if terms_top else (mbtags_top[0] if mbtags_top else "")
 
         # Numeric features
-        duration = to_float(get_field(f, "analysis", "duration"))
-        tempo = to_float(get_field(f, "analysis", "tempo"))
-        loudness = to_float(get_field(f, "analysis", "loudness"))
+        duration = to_float_fast(get_field(a, "duration"))
+        tempo = to_float_fast(get_field(a, "tempo"))
+        loudness = to_float_fast(get_field(a, "loudness"))
 
-        key = to_int(get_field(f, "analysis", "key"))
-        mode = to_int(get_field(f, "analysis", "mode"))
-        time_signature = to_int(get_field(f, "analysis", "time_signature"))
+        key = to_int(get_field(a, "key"))
+        mode = to_int(get_field(a, "mode"))
+        time_signature = to_int(get_field(a, "time_signature"))
 
-        danceability = to_float(get_field(f, "analysis", "danceability"))
-        energy = to_float(get_field(f, "analysis", "energy"))
+        danceability = to_float_fast(get_field(a, "danceability"))
+        energy = to_float_fast(get_field(a, "energy"))
 
-        key_conf = to_float(get_field(f, "analysis", "key_confidence"))
-        mode_conf = to_float(get_field(f, "analysis", "mode_confidence"))
-        ts_conf = to_float(get_field(f, "analysis", "time_signature_confidence"))
+        key_conf = to_float_fast(get_field(a, "key_confidence"))
+        mode_conf = to_float_fast(get_field(a, "mode_confidence"))
+        ts_conf = to_float_fast(get_field(a, "time_signature_confidence"))
 
-        end_fade_in = to_float(get_field(f, "analysis", "end_of_fade_in"))
-        start_fade_out = to_float(get_field(f, "analysis", "start_of_fade_out"))
+        end_fade_in = to_float_fast(get_field(a, "end_of_fade_in"))
+        start_fade_out = to_float_fast(get_field(a, "start_of_fade_out"))
 
-        song_hot = to_float(get_field(f, "metadata", "song_hotttnesss"))
-        artist_hot = to_float(get_field(f, "metadata", "artist_hotttnesss"))
-        artist_fam = to_float(get_field(f, "metadata", "artist_familiarity"))
+        song_hot = to_float_fast(get_field(m, "song_hotttnesss"))
+        artist_hot = to_float_fast(get_field(m, "artist_hotttnesss"))
+        artist_fam = to_float_fast(get_field(m, "artist_familiarity"))
 
         tracks_row = {
             "track_id": track_id,
@@ -286,52 +355,71 @@ def extract_one(h5_path: Path):
         return tracks_row, features_row
 
 
+"""
+Worker entry point: same as extract_one, but a broken file is reported as a
+skip instead of raising and tearing down the whole pool.
+"""
+def safe_extract_one(h5_path: Path):
+    try:
+        return extract_one(h5_path)
+    except Exception:
+        return None, None
+
+
 def main():
     OUT_TRACKS.parent.mkdir(parents=True, exist_ok=True)
     if not DATA_ROOT.exists():
         raise RuntimeError(f"DATA_ROOT not found: {DATA_ROOT}")
 
-    temp_tracks = OUT_TRACKS.with_suffix(".tmp.tracks.csv")
-    temp_features = OUT_FEATURES.with_suffix(".tmp.features.csv")
+    temp_tracks = OUT_TRACKS.with_suffix(".tmp.parquet")
+    temp_features = OUT_FEATURES.with_suffix(".tmp.parquet")
 
     processed = 0
     skipped = 0
     started = time.time()
-    seen_ids = set()
-
-    with temp_tracks.open("w", newline="", encoding="utf-8") as tracks_csvfile, \
-         temp_features.open("w", newline="", encoding="utf-8") as features_csvfile:
-
-        tracks_writer = csv.DictWriter(tracks_csvfile, fieldnames=TRACKS_FIELDS)
-        features_writer = csv.DictWriter(features_csvfile, fieldnames=FEATURE_FIELDS)
-        tracks_writer.writeheader()
-        features_writer.writeheader()
-
-        for h5_path in DATA_ROOT.rglob("*.h5"):
-            try:
-                tracks_row, feats_row = extract_one(h5_path)
-                if tracks_row is None:
-                    skipped += 1
-                    continue
-
-                tid = tracks_row["track_id"]
-                if tid in seen_ids:
-                    skipped += 1
-                    continue
-                seen_ids.add(tid)
-
-                tracks_writer.writerow(tracks_row)
-                features_writer.writerow(feats_row)
-                processed += 1
-
-                if processed % 500 == 0:
-                    elapsed = time.time() - started
-                    print(f"Processed {processed} tracks | skipped {skipped} | elapsed {elapsed:.1f}s")
-
-            except Exception:
+
+    tracks_buffer = []
+    features_buffer = []
+
+    with pq.ParquetWriter(temp_tracks, TRACKS_SCHEMA, compression="snappy") as tracks_writer, \
+         pq.ParquetWriter(temp_features, FEATURES_SCHEMA, compression="snappy") as features_writer:
+
+        paths = list(DATA_ROOT.rglob("*.h5"))
+        print(f"Found {len(paths)} .h5 files under {DATA_ROOT}")
+
+        # Files are decoded in worker processes; rows stream back in order and
+        # all writing stays on the main process. Duplicate track_ids are kept
+        # here and dropped by ingest.py (first occurrence wins).
+        results = Parallel(
+            n_jobs=N_JOBS,
+            backend="loky",
+            batch_size=BATCH_SIZE,
+            return_as="generator",
+        )(delayed(safe_extract_one)(p) for p in paths)
+
+        for tracks_row, feats_row in results:
+            if tracks_row is None:
                 skipped += 1
                 continue
 
+            tracks_buffer.append(tracks_row)
+            features_buffer.append(feats_row)
+            processed += 1
+
+            if len(tracks_buffer) >= WRITE_BATCH_ROWS:
+                tracks_writer.write_batch(to_record_batch(tracks_buffer, TRACKS_SCHEMA))
+                features_writer.write_batch(to_record_batch(features_buffer, FEATURES_SCHEMA))
+                tracks_buffer.clear()
+                features_buffer.clear()
+
+            if processed % 500 == 0:
+                elapsed = time.time() - started
+                print(f"Processed {processed} tracks | skipped {skipped} | elapsed {elapsed:.1f}s")
+
+        if tracks_buffer:
+            tracks_writer.write_batch(to_record_batch(tracks_buffer, TRACKS_SCHEMA))
+            features_writer.write_batch(to_record_batch(features_buffer, FEATURES_SCHEMA))
+
     if OUT_TRACKS.exists():
         OUT_TRACKS.unlink()
     if OUT_FEATURES.exists():
@@ -1,7 +1,11 @@
 import os
+import struct
+from io import BytesIO, StringIO
+from itertools import islice
 from pathlib import Path
 
-import pandas as pd
+import duckdb
+import numpy as np
 from dotenv import load_dotenv
 from sqlalchemy import create_engine, text
 
@@ -17,12 +21,27 @@ ENGINE = create_engine(DATABASE_URL, future=True, pool_pre_ping=True)
 ROOT = Path(__file__).resolve().parents[1]
 SCHEMA_PATH = ROOT / "src" / "schema.sql"
 
-TRACKS_PATH = ROOT / "data" / "tracks.csv"
-FEATURES_PATH = ROOT / "data" / "features.csv"
+TRACKS_PATH = ROOT / "data" / "tracks.parquet"
+FEATURES_PATH = ROOT / "data" / "features.parquet"
 
 RESET_TABLES = True
 CHUNK_SIZE = 5000
 
+SONG_COLS = [
+    "track_id",
+    "title",
+    "artist",
+    "year",
+    "release",
+    "genre",
+    "artist_terms_top",
+    "artist_mbtags_top",
+]
+
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+FLOAT8_OID = 701
+
 VECTOR_COLS = [
     "duration",
     "tempo",
@@ -35,18 +54,6 @@ VECTOR_COLS = [
 ]
 
 
-"""
-Convert 'a|b|c' -> ['a','b','c'] ; blanks -> []
-"""
-def pipe_to_list(val):
-    if val is None:
-        return []
-    s = str(val).strip()
-    if not s:
-        return []
-    return [x.strip() for x in s.split("|") if x.strip()]
-
-
 """
 Execute schema.sql (idempotent) inside an open transaction.
 """
@@ -63,80 +70,267 @@ def execute_sql(conn, schema_file: Path):
 
 
 def chunker(rows, size):
-    for i in range(0, len(rows), size):
-        yield rows[i:i + size]
+    it = iter(rows)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+
+"""
+Format a list of ints (genre_terms ids) as a Postgres array literal, e.g. [3, 7] -> {3,7}.
+"""
+def pg_array(items):
+    return "{" + ",".join(str(int(x)) for x in items) + "}"
+
+
+"""
+Format one value for COPY ... FROM STDIN (text format). Missing -> \\N.
+"""
+def copy_value(val):
+    if isinstance(val, list):
+        val = pg_array(val)
+    elif val is None or val != val:
+        return "\\N"
+    return (
+        str(val)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+"""
+Stream row tuples into Postgres with COPY, one CHUNK_SIZE buffer at a time.
+Returns the number of rows copied.
+"""
+def copy_rows(cur, table, columns, rows):
+    sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN"
+    copied = 0
+    for chunk in chunker(rows, CHUNK_SIZE):
+        buf = StringIO("".join("\t".join(copy_value(v) for v in row) + "\n" for row in chunk))
+        cur.copy_expert(sql, buf)
+        copied += len(chunk)
+    return copied
+
+
+"""
+Encode an Arrow batch of (track_id, features DOUBLE[]) as binary COPY tuples.
+The float8[] payloads (array header + length-prefixed big-endian doubles) for
+the whole batch are packed by a single numpy record array, so no per-element
+Python floats are created and Postgres skips parsing array literals.
+"""
+def encode_features_batch(batch):
+    m = len(batch)
+    d = len(VECTOR_COLS)
+    values = batch.column(1).flatten().to_numpy().reshape(m, d)
+
+    payload = np.empty(m, dtype=[
+        ("size", ">i4"),
+        ("header", ">i4", 5),  # ndim, has_nulls, element oid, dim size, lower bound
+        ("elems", [("len", ">i4"), ("val", ">f8")], d),
+    ])
+    payload["size"] = payload.dtype.itemsize - 4
+    payload["header"] = (1, 0, FLOAT8_OID, d, 1)
+    payload["elems"]["len"] = 8
+    payload["elems"]["val"] = values
+
+    raw = payload.tobytes()
+    stride = payload.dtype.itemsize
+    out = bytearray()
+    for i, tid in enumerate(batch.column(0).to_pylist()):
+        tid = tid.encode("utf-8")
+        out += struct.pack(">hi", 2, len(tid))
+        out += tid
+        out += raw[i * stride:(i + 1) * stride]
+    return bytes(out)
+
+
+"""
+Stream song_features into Postgres with binary COPY, one Arrow batch per COPY.
+Returns the number of rows copied.
+"""
+def copy_features(cur, table, batches):
+    sql = f"COPY {table} (track_id, features) FROM STDIN WITH (FORMAT BINARY)"
+    copied = 0
+    for batch in batches:
+        if len(batch) == 0:
+            continue
+        cur.copy_expert(sql, BytesIO(COPY_HEADER + encode_features_batch(batch) + COPY_TRAILER))
+        copied += len(batch)
+    return copied
+
+
+"""
+DuckDB expression turning 'a|b|c' into ['a','b','c'] (blanks dropped, NULL -> []).
+Runs vectorized inside the query instead of once per row in Python.
+"""
+def pipe_to_list(col):
+    return (
+        f"list_filter(list_transform(string_split(coalesce({col}, ''), '|'), "
+        f"lambda x: trim(x)), lambda x: x <> '')"
+    )
+
+
+"""
+Quote a path as a DuckDB string literal (views can't take bound parameters).
+"""
+def sql_path(path: Path):
+    return "'" + str(path).replace("'", "''") + "'"
+
+
+"""
+Define the tracks/features join (clean, filter, dedup) as a DuckDB view.
+Nothing is materialized: each COPY below streams its own pass over the
+Parquet files, reading only the columns it needs.
+"""
+def create_merged_view(con):
+    vectors_present = " AND ".join(f"f.{c} IS NOT NULL" for c in VECTOR_COLS)
+    vector_values = ", ".join(f"CAST(f.{c} AS DOUBLE)" for c in VECTOR_COLS)
+
+    con.execute(f"""
+        CREATE TEMP VIEW merged AS
+        SELECT
+            t.track_id,
+            t.title,
+            t.artist,
+            CASE WHEN t.year > 0 THEN t.year END AS year,
+            t.release,
+            t.genre,
+            {pipe_to_list("t.artist_terms_top")} AS artist_terms_top,
+            {pipe_to_list("t.artist_mbtags_top")} AS artist_mbtags_top,
+            list_value({vector_values}) AS features
+        FROM (
+            SELECT * REPLACE (trim(track_id) AS track_id, trim(title) AS title, trim(artist) AS artist)
+            FROM read_parquet({sql_path(TRACKS_PATH)}, file_row_number = true)
+        ) t
+        JOIN (
+            SELECT trim(track_id) AS track_id, file_row_number, {", ".join(VECTOR_COLS)}
+            FROM read_parquet({sql_path(FEATURES_PATH)}, file_row_number = true)
+        ) f USING (track_id)
+        WHERE t.title IS NOT NULL AND t.artist IS NOT NULL AND {vectors_present}
+        QUALIFY row_number() OVER (
+            PARTITION BY t.track_id ORDER BY t.file_row_number, f.file_row_number
+        ) = 1
+    """)
+
+
+"""
+Fail fast if songs still has the pre-dictionary TEXT[] tag columns.
+CREATE TABLE IF NOT EXISTS never alters an existing table, and COPY would
+happily store the ids as strings ('3', '7') in a TEXT[] column.
+"""
+def check_tag_columns(conn):
+    rows = conn.execute(text("""
+        SELECT column_name, udt_name
+        FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'songs'
+          AND column_name IN ('artist_terms_top', 'artist_mbtags_top')
+    """)).fetchall()
+
+    stale = [f"{col} ({udt})" for col, udt in rows if udt != "_int2"]
+    if stale:
+        raise RuntimeError(
+            "songs tag columns are not SMALLINT[]: " + ", ".join(stale)
+            + ". This database predates genre_terms; reset it "
+            "(docker compose down -v && docker compose up -d db) and re-run ingest.py."
+        )
+
+
+"""
+Make sure every tag/term name in tracks.parquet has a genre_terms id and
+return the full {name: id} dictionary used to encode the songs arrays.
+"""
+def sync_genre_terms(conn, con):
+    names = [name for (name,) in con.execute(f"""
+        SELECT DISTINCT name FROM (
+            SELECT unnest({pipe_to_list("artist_terms_top")}) AS name FROM read_parquet(?)
+            UNION ALL
+            SELECT unnest({pipe_to_list("artist_mbtags_top")}) AS name FROM read_parquet(?)
+        )
+        ORDER BY name
+    """, [str(TRACKS_PATH), str(TRACKS_PATH)]).fetchall()]
+
+    # Only insert names that are new: a conflicting insert would still burn a
+    # SMALLSERIAL value, and re-runs would exhaust the 16-bit id space.
+    conn.execute(
+        text("""
+            INSERT INTO genre_terms (name)
+            SELECT n FROM unnest(CAST(:names AS TEXT[])) AS n
+            WHERE NOT EXISTS (SELECT 1 FROM genre_terms g WHERE g.name = n)
+            ON CONFLICT (name) DO NOTHING;
+        """),
+        {"names": names},
+    )
+    return {name: tid for tid, name in conn.execute(text("SELECT id, name FROM genre_terms"))}
+
+
+"""
+Yield Arrow record batches for a DuckDB query. Lazy: the query only runs once
+iteration starts, so streams can be set up before the COPYs consume them.
+"""
+def stream_batches(con, sql):
+    yield from con.execute(sql).to_arrow_reader(CHUNK_SIZE)
+
+
+"""
+Yield row tuples for a DuckDB query, one Arrow record batch at a time.
+"""
+def stream_rows(con, sql):
+    for batch in stream_batches(con, sql):
+        yield from zip(*(col.to_pylist() for col in batch.columns))
+
 
 def main():
-    # 1) load CSVs
-    tracks = pd.read_csv(TRACKS_PATH)
-    features = pd.read_csv(FEATURES_PATH)
-
-    # 2) Basic clean and typing
-    tracks["track_id"] = tracks["track_id"].astype(str).str.strip()
-    tracks["title"] = tracks["title"].astype(str).str.strip()
-    tracks["artist"] = tracks["artist"].astype(str).str.strip()
-
-    # nullable int year
-    tracks["year"] = pd.to_numeric(tracks.get("year"), errors="coerce")
-    tracks["year"] = tracks["year"].where(tracks["year"].fillna(0) > 0, pd.NA).astype("Int64")
-    
-    # optional columns
-    if "release" not in tracks.columns:
-        tracks["release"] = pd.NA
-    if "genre" not in tracks.columns:
-        tracks["genre"] = pd.NA
-    if "artist_terms_top" not in tracks.columns:
-        tracks["artist_terms_top"] = ""
-    if "artist_mbtags_top" not in tracks.columns:
-        tracks["artist_mbtags_top"] = ""
-
-    # Convert pipe-delimited -> Postgres TEXT[]
-    tracks["artist_terms_top"] = tracks["artist_terms_top"].apply(pipe_to_list)
-    tracks["artist_mbtags_top"] = tracks["artist_mbtags_top"].apply(pipe_to_list)
-
-    features["track_id"] = features["track_id"].astype(str).str.strip()
-
-    # force numeric for vector columns
-    for col in VECTOR_COLS:
-        features[col] = pd.to_numeric(features.get(col), errors="coerce")
-
-    if "year" in features.columns:
-        features["year"] = pd.to_numeric(features["year"], errors="coerce")
-
-    # 3) Merge to keep tracks that have both metadata and vector features
-    merged = tracks.merge(features[["track_id"] + VECTOR_COLS], on="track_id", how="inner")
-    merged = merged.dropna(subset=["track_id", "title", "artist"])
-    merged = merged.dropna(subset=VECTOR_COLS)
-    merged["features"] = merged[VECTOR_COLS].astype(float).values.tolist()
-    merged = merged.drop_duplicates(subset=["track_id"])
-
-    print(f"tracks.csv rows:   {len(tracks)}")
-    print(f"features.csv rows: {len(features)}")
-    print(f"merged rows:       {len(merged)} (will be inserted)")
-
-    # 4) Build rows for DB
-    song_rows = merged[
-        ["track_id", "title", "artist", "year", "release", "genre", "artist_terms_top", "artist_mbtags_top"]
-    ].to_dict(orient="records")
-
-    feat_rows = merged[["track_id", "features"]].to_dict(orient="records")
-
-    # 5) Run schema and insert data
+    con = duckdb.connect()
+
+    # 1) Join + clean tracks/features in DuckDB (lazily, as a view)
+    create_merged_view(con)
+
+    n_tracks = con.execute("SELECT count(*) FROM read_parquet(?)", [str(TRACKS_PATH)]).fetchone()[0]
+    n_features = con.execute("SELECT count(*) FROM read_parquet(?)", [str(FEATURES_PATH)]).fetchone()[0]
+
+    print(f"tracks.parquet rows:   {n_tracks}")
+    print(f"features.parquet rows: {n_features}")
+
+    # 2) Run schema and load data
     with ENGINE.begin() as conn:
         execute_sql(conn, SCHEMA_PATH)
+        check_tag_columns(conn)
+
+        # Tag/term names -> genre_terms ids (SMALLINT[] on songs)
+        term_ids = sync_genre_terms(conn, con)
+        print(f"genre_terms:           {len(term_ids)} names")
+
+        # Stream rows for DB straight out of DuckDB
+        song_rows = (
+            (*row[:6], [term_ids[t] for t in row[6]], [term_ids[t] for t in row[7]])
+            for row in stream_rows(con, f"SELECT {', '.join(SONG_COLS)} FROM merged")
+        )
+        feat_batches = stream_batches(con, "SELECT track_id, features FROM merged")
 
         if RESET_TABLES:
+            # Tables are empty, so COPY straight into them
             conn.execute(text("TRUNCATE songs CASCADE;"))
-
-        # Upsert SONGS
-        for chunk in chunker(song_rows, CHUNK_SIZE):
-            stmt = text("""
+            songs_table, features_table = "songs", "song_features"
+        else:
+            # COPY into staging tables, then upsert from them below
+            conn.execute(text("CREATE TEMP TABLE songs_stage (LIKE songs) ON COMMIT DROP;"))
+            conn.execute(text("CREATE TEMP TABLE song_features_stage (LIKE song_features) ON COMMIT DROP;"))
+            songs_table, features_table = "songs_stage", "song_features_stage"
+
+        cur = conn.connection.cursor()
+        n_songs = copy_rows(cur, songs_table, SONG_COLS, song_rows)
+        copy_features(cur, features_table, feat_batches)
+        print(f"merged rows:           {n_songs} (inserted)")
+
+        if not RESET_TABLES:
+            conn.execute(text("""
                 INSERT INTO songs (
                     track_id, title, artist, year, release, genre, artist_terms_top, artist_mbtags_top
                 )
-                VALUES (
-                    :track_id, :title, :artist, :year, :release, :genre, :artist_terms_top, :artist_mbtags_top
-                )
+                SELECT track_id, title, artist, year, release, genre, artist_terms_top, artist_mbtags_top
+                FROM songs_stage
                 ON CONFLICT (track_id) DO UPDATE SET
                     title = EXCLUDED.title,
                     artist = EXCLUDED.artist,
@@ -145,21 +339,15 @@ def main():
                     genre = EXCLUDED.genre,
                     artist_terms_top = EXCLUDED.artist_terms_top,
                     artist_mbtags_top = EXCLUDED.artist_mbtags_top;
-            """)
-            conn.execute(stmt, chunk)
-        
-        # Upsert features vector
-        for chunk in chunker(feat_rows, CHUNK_SIZE):
-            conn.execute(
-                text("""
-                    INSERT INTO song_features (track_id, features)
-                    VALUES (:track_id, :features)
-                    ON CONFLICT (track_id) DO UPDATE
-                    SET features = EXCLUDED.features;
-                """),
-                chunk,
-            )
-        
+            """))
+            conn.execute(text("""
+                INSERT INTO song_features (track_id, features)
+                SELECT track_id, features
+                FROM song_features_stage
+                ON CONFLICT (track_id) DO UPDATE
+                SET features = EXCLUDED.features;
+            """))
+
     print("Data ingestion complete.")
 
 if __name__ == "__main__":
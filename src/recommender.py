@@ -13,22 +13,24 @@ MODELS_DIR = ROOT / "models"
 ARTIFACTS = None
 
 """
-Load scaler, PCA, KNN, and track_ids artifacts from disk.
+Load scaler, PCA, embeddings, and track_ids artifacts from disk.
+The .npy files are memory-mapped, so worker processes share one page-cached copy.
 """
 def load_artifacts():
     global ARTIFACTS
     if ARTIFACTS is not None:
         return ARTIFACTS
     
-    scaler = joblib.load(MODELS_DIR / "scaler.pkl")
+    with np.load(MODELS_DIR / "scaler.npz") as npz:
+        scaler = (npz["mean"].astype(np.float32), npz["scale"].astype(np.float32))
 
     pca_path = MODELS_DIR / "pca.pkl"
     pca = joblib.load(pca_path) if pca_path.exists() else None
 
-    knn = joblib.load(MODELS_DIR / "knn.pkl")
-    index_track_ids = np.load(MODELS_DIR / "track_ids.npy", allow_pickle=True)
+    embeddings = np.load(MODELS_DIR / "embeddings.npy", mmap_mode="r")
+    index_track_ids = np.load(MODELS_DIR / "track_ids.npy", mmap_mode="r")
 
-    ARTIFACTS = (scaler, pca, knn, index_track_ids)
+    ARTIFACTS = (scaler, pca, embeddings, index_track_ids)
 
     return ARTIFACTS
 
@@ -55,7 +57,7 @@ def fetch_vectors(track_ids):
     for tid, features in rows:
         if tid is None or features is None:
             continue
-        out[str(tid)] = np.array(features, dtype=np.float64)
+        out[str(tid)] = np.array(features, dtype=np.float32)
     return out
 
 """
@@ -94,7 +96,8 @@ def fetch_metadata(track_ids):
 Given a track_id, return the top k most similar tracks based on the KNN index.
 """
 def embed(X, scaler, pca):
-    X_scaled = scaler.transform(X)
+    mean, scale = scaler
+    X_scaled = (X - mean) / scale
     X_emb = pca.transform(X_scaled) if pca is not None else X_scaled
     return normalize(X_emb, norm="l2")
 
@@ -111,7 +114,7 @@ def recommend(seed_track_ids, k=20, per_artist_cap=2):
     
     seed_track_ids = [str(t).strip() for t in seed_track_ids if str(t).strip()]
 
-    scaler, pca, knn, index_track_ids = load_artifacts()
+    scaler, pca, embeddings, index_track_ids = load_artifacts()
 
     seed_map = fetch_vectors(seed_track_ids)
     found = list(seed_map.keys())
@@ -127,8 +130,11 @@ def recommend(seed_track_ids, k=20, per_artist_cap=2):
     buffer = max(200, k * 15)
     n_neighbors = min(len(index_track_ids), k + buffer)
 
-    distances, indices = knn.kneighbors(user_vec, n_neighbors=n_neighbors)
-    candidate_ids = [str(index_track_ids[i]) for i in indices[0]]
+    # Exact cosine search: embeddings are unit vectors, so a dot product is enough
+    scores = embeddings @ user_vec[0].astype(np.float32)
+    top = np.argpartition(-scores, n_neighbors - 1)[:n_neighbors]
+    top = top[np.argsort(-scores[top])]
+    candidate_ids = [str(index_track_ids[i]) for i in top]
 
     seed_set = set(found)
     candidate_ids = [tid for tid in candidate_ids if tid not in seed_set]